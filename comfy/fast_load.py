@@ -0,0 +1,76 @@
+import concurrent.futures
+import json
+import os
+import struct
+
+import torch
+
+#parallel .safetensors reader: the tensor data is read with several threads into one host buffer instead of
+#going through page faults on a mmaped file.
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+def read_header(path):
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header, 8 + header_size
+
+def _read_range(path, view, file_offset, start, end):
+    with open(path, "rb", buffering=0) as f:
+        f.seek(file_offset + start)
+        pos = start
+        while pos < end:
+            n = f.readinto(view[pos:min(pos + READ_CHUNK_SIZE, end)])
+            if not n:
+                raise EOFError("Unexpected end of file while reading {}".format(path))
+            pos += n
+
+def load_file(path, num_threads=None):
+    header, data_start = read_header(path)
+    for k in header:
+        if header[k]["dtype"] not in DTYPES:
+            #let the safetensors library handle the less common dtypes (fp8, unsigned ints, ...)
+            import safetensors.torch
+            return safetensors.torch.load_file(path, device="cpu")
+
+    data_size = 0
+    for k in header:
+        data_size = max(data_size, header[k]["data_offsets"][1])
+
+    buf = torch.empty(data_size, dtype=torch.uint8)
+    if data_size > 0:
+        if num_threads is None:
+            num_threads = min(len(header), os.cpu_count() or 1)
+        num_threads = max(1, num_threads)
+        step = -(-data_size // num_threads)
+        view = memoryview(buf.numpy())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as ex:
+            futures = [ex.submit(_read_range, path, view, data_start, s, min(s + step, data_size)) for s in range(0, data_size, step)]
+            for f in futures:
+                f.result()
+
+    sd = {}
+    for k in header:
+        info = header[k]
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        t = buf[begin:end]
+        if begin % torch.tensor([], dtype=dtype).element_size() != 0:
+            t = t.clone()
+        sd[k] = t.view(dtype).reshape(info["shape"])
+    return sd
@@ -119,8 +119,9 @@ class KSampler:
                 "sample_lms", "sample_dpm_fast", "sample_dpm_adaptive", "sample_dpmpp_2s_ancestral", "sample_dpmpp_sde",
                 "sample_dpmpp_2m"]
 
-    def __init__(self, model, steps, device, sampler=None, scheduler=None, denoise=None):
+    def __init__(self, model, steps, device, sampler=None, scheduler=None, denoise=None, autocast_dtype=None):
         self.model = model
+        self.autocast_dtype = autocast_dtype
         if self.model.parameterization == "v":
             self.model_wrap = k_diffusion.external.CompVisVDenoiser(self.model, quantize=True)
         else:
@@ -190,7 +191,9 @@ class KSampler:
         for c in negative:
             create_cond_with_same_area_if_none(positive, c)
 
-        if self.model.model.diffusion_model.dtype == torch.float16:
+        if self.autocast_dtype is not None:
+            precision_scope = lambda device: torch.autocast(device, dtype=self.autocast_dtype)
+        elif self.model.model.diffusion_model.dtype == torch.float16:
             precision_scope = torch.autocast
         else:
             precision_scope = contextlib.nullcontext
@@ -1,5 +1,7 @@
 import torch
+import inspect
 
+import fast_load
 import sd1_clip
 import sd2_clip
 from ldm.util import instantiate_from_config
@@ -7,20 +9,34 @@ from ldm.models.autoencoder import AutoencoderKL
 from omegaconf import OmegaConf
 
 
-def load_model_from_config(config, ckpt, verbose=False, load_state_dict_to=[]):
-    print(f"Loading model from {ckpt}")
-
+def load_torch_file(ckpt, device="cpu", mmap=True):
     if ckpt.lower().endswith(".safetensors"):
-        import safetensors.torch
-        sd = safetensors.torch.load_file(ckpt, device="cpu")
+        #safetensors files are read with large parallel reads instead of being mmaped so mmap only applies to .ckpt
+        sd = fast_load.load_file(ckpt)
+        if device != "cpu":
+            sd = {k: v.to(device) for k, v in sd.items()}
     else:
-        pl_sd = torch.load(ckpt, map_location="cpu")
+        pl_sd = None
+        if mmap and "mmap" in inspect.signature(torch.load).parameters:
+            try:
+                pl_sd = torch.load(ckpt, map_location=device, mmap=True)
+            except RuntimeError:
+                #old non zipfile checkpoints can't be mmaped
+                pl_sd = None
+        if pl_sd is None:
+            pl_sd = torch.load(ckpt, map_location=device)
         if "global_step" in pl_sd:
             print(f"Global Step: {pl_sd['global_step']}")
         if "state_dict" in pl_sd:
             sd = pl_sd["state_dict"]
         else:
             sd = pl_sd
+    return sd
+
+def load_model_from_config(config, ckpt, verbose=False, load_state_dict_to=[], mmap=True):
+    print(f"Loading model from {ckpt}")
+
+    sd = load_torch_file(ckpt, mmap=mmap)
     model = instantiate_from_config(config.model)
 
     m, u = model.load_state_dict(sd, strict=False)
@@ -78,32 +94,52 @@ class VAE:
         if config is None:
             #default SD1.x/SD2.x VAE parameters
             ddconfig = {'double_z': True, 'z_channels': 4, 'resolution': 256, 'in_channels': 3, 'out_ch': 3, 'ch': 128, 'ch_mult': [1, 2, 4, 4], 'num_res_blocks': 2, 'attn_resolutions': [], 'dropout': 0.0}
-            self.first_stage_model = AutoencoderKL(ddconfig, {'target': 'torch.nn.Identity'}, 4, monitor="val/rec_loss", ckpt_path=ckpt_path)
+            self.first_stage_model = AutoencoderKL(ddconfig, {'target': 'torch.nn.Identity'}, 4, monitor="val/rec_loss")
         else:
-            self.first_stage_model = AutoencoderKL(**(config['params']), ckpt_path=ckpt_path)
-        self.first_stage_model = self.first_stage_model.eval()
+            self.first_stage_model = AutoencoderKL(**(config['params']))
+        if ckpt_path is not None:
+            sd = load_torch_file(ckpt_path)
+            self.first_stage_model.load_state_dict(sd, strict=False)
+        #the vae is all convolutions, NHWC is faster for those on tensor core gpus
+        self.first_stage_model = self.first_stage_model.eval().to(memory_format=torch.channels_last)
         self.scale_factor = scale_factor
         self.device = device
 
+    def slice_size(self, batch_size, pixels_per_image):
+        if torch.device(self.device).type != "cuda":
+            return batch_size
+        #very rough estimate of the peak activation memory the vae needs per image
+        memory_per_image = pixels_per_image * 1100 * next(self.first_stage_model.parameters()).element_size()
+        free_memory = torch.cuda.mem_get_info(self.device)[0] + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return max(1, min(batch_size, int(free_memory // memory_per_image)))
+
     def decode(self, samples):
         self.first_stage_model = self.first_stage_model.to(self.device)
-        samples = samples.to(self.device)
-        pixel_samples = self.first_stage_model.decode(1. / self.scale_factor * samples)
-        pixel_samples = torch.clamp((pixel_samples + 1.0) / 2.0, min=0.0, max=1.0)
+        batch = self.slice_size(samples.shape[0], samples.shape[2] * samples.shape[3] * 64)
+        pixel_samples = []
+        for i in range(0, samples.shape[0], batch):
+            s = samples[i:i + batch].to(self.device, memory_format=torch.channels_last)
+            s = self.first_stage_model.decode(1. / self.scale_factor * s)
+            s = torch.clamp((s + 1.0) / 2.0, min=0.0, max=1.0)
+            pixel_samples += [s.cpu()]
         self.first_stage_model = self.first_stage_model.cpu()
-        pixel_samples = pixel_samples.cpu().movedim(1,-1)
+        pixel_samples = torch.cat(pixel_samples).movedim(1,-1)
         return pixel_samples
 
     def encode(self, pixel_samples):
         self.first_stage_model = self.first_stage_model.to(self.device)
-        pixel_samples = pixel_samples.movedim(-1,1).to(self.device)
-        samples = self.first_stage_model.encode(2. * pixel_samples - 1.).sample() * self.scale_factor
+        batch = self.slice_size(pixel_samples.shape[0], pixel_samples.shape[1] * pixel_samples.shape[2])
+        samples = []
+        for i in range(0, pixel_samples.shape[0], batch):
+            s = pixel_samples[i:i + batch].movedim(-1,1).to(self.device, memory_format=torch.channels_last)
+            s = self.first_stage_model.encode(2. * s - 1.).sample() * self.scale_factor
+            samples += [s.cpu()]
         self.first_stage_model = self.first_stage_model.cpu()
-        samples = samples.cpu()
+        samples = torch.cat(samples)
         return samples
 
 
-def load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True):
+def load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, mmap=True):
     config = OmegaConf.load(config_path)
     model_config_params = config['model']['params']
     clip_config = model_config_params['cond_stage_config']
@@ -128,5 +164,5 @@ def load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True):
         w.cond_stage_model = clip.cond_stage_model
         load_state_dict_to = [w]
 
-    model = load_model_from_config(config, ckpt_path, verbose=False, load_state_dict_to=load_state_dict_to)
+    model = load_model_from_config(config, ckpt_path, verbose=False, load_state_dict_to=load_state_dict_to, mmap=mmap)
     return (model, clip, vae)
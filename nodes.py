@@ -4,29 +4,82 @@ import os
 import sys
 import json
 import hashlib
-import copy
+import concurrent.futures
+import functools
+import collections
+import contextlib
+import weakref
 
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 import numpy as np
 
+#still needed for the internal imports of the comfy modules, comfy.samplers and comfy.sd themselves are imported
+#where they are used so that startup and the node list don't wait for the model code to load
 sys.path.append(os.path.join(sys.path[0], "comfy"))
 
-
-import comfy.samplers
-import comfy.sd
-
-supported_ckpt_extensions = ['.ckpt']
-try:
-    import safetensors.torch
-    supported_ckpt_extensions += ['.safetensors']
-except:
-    print("Could not import safetensors, safetensors support disabled.")
-
-def filter_files_extensions(files, extensions):
-    return sorted(list(filter(lambda a: os.path.splitext(a)[-1].lower() in extensions, files)))
+@functools.lru_cache(maxsize=None)
+def have_safetensors():
+    try:
+        import safetensors.torch
+        return True
+    except:
+        print("Could not import safetensors, safetensors support disabled.")
+        return False
+
+def supported_ckpt_extensions():
+    if have_safetensors():
+        return ['.ckpt', '.safetensors']
+    return ['.ckpt']
+
+def filter_files_extensions(path, extensions=None):
+    with os.scandir(path) as it:
+        if extensions is None:
+            return sorted(e.name for e in it if e.is_file())
+        extensions = frozenset(e.lower() for e in extensions)
+        return sorted(e.name for e in it if os.path.splitext(e.name)[1].lower() in extensions and e.is_file())
+
+@functools.lru_cache(maxsize=64)
+def _scan_dir(path, mtime_ns, extensions):
+    return tuple(filter_files_extensions(path, extensions))
+
+#the directory mtime changes whenever a file is added, removed or renamed so it invalidates the cached listing
+def get_filename_list(path, extensions=None):
+    if extensions is not None:
+        extensions = tuple(extensions)
+    return list(_scan_dir(path, os.stat(path).st_mtime_ns, extensions))
+
+@functools.lru_cache(maxsize=None)
+def get_autocast_dtype(device):
+    #COMFY_AUTOCAST_DTYPE can be set to bf16 (ampere or newer only) or fp16, the default fp32 disables autocast
+    if torch.device(device).type != "cuda":
+        return None
+    dtype = os.environ.get("COMFY_AUTOCAST_DTYPE", "fp32")
+    if dtype == "fp16":
+        return torch.float16
+    if dtype == "bf16" and torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.bfloat16
+    return None
+
+def autocast(device):
+    dtype = get_autocast_dtype(device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast("cuda", dtype=dtype)
+
+compile_models = os.environ.get("COMFY_TORCH_COMPILE", "0") == "1"
+compiled_modules = weakref.WeakSet()
+
+def compile_module(module):
+    #only the forward of the instance is replaced so the state dict keys don't change
+    if compile_models and hasattr(torch, "compile") and module not in compiled_modules:
+        module.forward = torch.compile(module.forward)
+        compiled_modules.add(module)
 
 class CLIPTextEncode:
+    cache = collections.OrderedDict()
+    cache_size = 128
+
     @classmethod
     def INPUT_TYPES(s):
         return {"required": {"text": ("STRING", {"multiline": True}), "clip": ("CLIP", )}}
@@ -35,8 +88,25 @@ class CLIPTextEncode:
 
     CATEGORY = "conditioning"
 
+    @classmethod
+    def clear_unused_cache(s):
+        for k in [k for k in s.cache if s.cache[k][0]() is None]:
+            del s.cache[k]
+
     def encode(self, clip, text):
-        return ([[clip.encode(text), {}]], )
+        key = (id(clip), text)
+        entry = self.cache.get(key)
+        #ids get reused once an object is freed so also check that the entry belongs to this clip
+        if entry is not None and entry[0]() is clip:
+            self.cache.move_to_end(key)
+            cond = entry[1]
+        else:
+            cond = clip.encode(text)
+            self.cache[key] = (weakref.ref(clip), cond)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ([[cond, {}]], )
 
 class ConditioningCombine:
     @classmethod
@@ -66,7 +136,7 @@ class ConditioningSetArea:
     CATEGORY = "conditioning"
 
     def append(self, conditioning, width, height, x, y, strength, min_sigma=0.0, max_sigma=99.0):
-        c = copy.deepcopy(conditioning)
+        c = [[t[0], t[1].copy()] + t[2:] for t in conditioning]
         for t in c:
             t[1]['area'] = (height // 8, width // 8, y // 8, x // 8)
             t[1]['strength'] = strength
@@ -87,7 +157,10 @@ class VAEDecode:
     CATEGORY = "latent"
 
     def decode(self, vae, samples):
-        return (vae.decode(samples), )
+        compile_module(vae.first_stage_model.decoder)
+        with autocast(vae.device):
+            pixels = vae.decode(samples)
+        return (pixels.float(), )
 
 class VAEEncode:
     def __init__(self, device="cpu"):
@@ -106,7 +179,10 @@ class VAEEncode:
         y = (pixels.shape[2] // 64) * 64
         if pixels.shape[1] != x or pixels.shape[2] != y:
             pixels = pixels[:,:x,:y,:]
-        return (vae.encode(pixels), )
+        compile_module(vae.first_stage_model.encoder)
+        with autocast(vae.device):
+            samples = vae.encode(pixels)
+        return (samples.float(), )
 
 class CheckpointLoader:
     models_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
@@ -115,8 +191,8 @@ class CheckpointLoader:
 
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": { "config_name": (filter_files_extensions(os.listdir(s.config_dir), '.yaml'), ),
-                              "ckpt_name": (filter_files_extensions(os.listdir(s.ckpt_dir), supported_ckpt_extensions), )}}
+        return {"required": { "config_name": (get_filename_list(s.config_dir, ['.yaml']), ),
+                              "ckpt_name": (get_filename_list(s.ckpt_dir, supported_ckpt_extensions()), )}}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
 
@@ -125,6 +201,8 @@ class CheckpointLoader:
     def load_checkpoint(self, config_name, ckpt_name, output_vae=True, output_clip=True):
         config_path = os.path.join(self.config_dir, config_name)
         ckpt_path = os.path.join(self.ckpt_dir, ckpt_name)
+        import comfy.sd
+        CLIPTextEncode.clear_unused_cache()
         return comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True)
 
 class VAELoader:
@@ -132,7 +210,7 @@ class VAELoader:
     vae_dir = os.path.join(models_dir, "vae")
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": { "vae_name": (filter_files_extensions(os.listdir(s.vae_dir), supported_ckpt_extensions), )}}
+        return {"required": { "vae_name": (get_filename_list(s.vae_dir, supported_ckpt_extensions()), )}}
     RETURN_TYPES = ("VAE",)
     FUNCTION = "load_vae"
 
@@ -141,11 +219,14 @@ class VAELoader:
     #TODO: scale factor?
     def load_vae(self, vae_name):
         vae_path = os.path.join(self.vae_dir, vae_name)
+        import comfy.sd
         vae = comfy.sd.VAE(ckpt_path=vae_path)
         return (vae,)
 
 class EmptyLatentImage:
-    def __init__(self, device="cpu"):
+    def __init__(self, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
 
     @classmethod
@@ -159,7 +240,7 @@ class EmptyLatentImage:
     CATEGORY = "latent"
 
     def generate(self, width, height, batch_size=1):
-        latent = torch.zeros([batch_size, 4, height // 8, width // 8])
+        latent = torch.zeros([batch_size, 4, height // 8, width // 8], device=self.device)
         return (latent, )
 
 class LatentUpscale:
@@ -195,12 +276,28 @@ class LatentUpscale:
         s = torch.nn.functional.interpolate(s, size=(height // 8, width // 8), mode=upscale_method)
         return (s,)
 
+def _prepare_cond(conds, batch_size, device, cache):
+    #move each unique tensor to the device once and broadcast it to the batch size there
+    out = []
+    for c in conds:
+        t = c[0]
+        if id(t) not in cache:
+            d = t.to(device, non_blocking=True)
+            if d.shape[0] == 1 and batch_size > 1:
+                d = d.expand(batch_size, *d.shape[1:]).contiguous()
+            elif d.shape[0] < batch_size:
+                d = torch.cat([d] * batch_size)
+            cache[id(t)] = d
+        out += [[cache[id(t)]] + c[1:]]
+    return out
+
 class KSampler:
     def __init__(self, device="cuda"):
         self.device = device
 
     @classmethod
     def INPUT_TYPES(s):
+        import comfy.samplers
         return {"required": 
                     {"model": ("MODEL",),
                     "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
@@ -220,29 +317,21 @@ class KSampler:
     CATEGORY = "sampling"
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
-        noise = torch.randn(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, generator=torch.manual_seed(seed), device="cpu")
+        import comfy.samplers
+        #noise is still generated on the cpu so seeds give the same images on every device
+        pin = torch.device(self.device).type == "cuda"
+        noise = torch.randn(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, generator=torch.manual_seed(seed), device="cpu", pin_memory=pin)
+        noise = noise.to(self.device, non_blocking=True)
+        latent_image = latent_image.to(self.device, non_blocking=True)
         model = model.to(self.device)
-        noise = noise.to(self.device)
-        latent_image = latent_image.to(self.device)
-
-        positive_copy = []
-        negative_copy = []
-
-        for p in positive:
-            t = p[0]
-            if t.shape[0] < noise.shape[0]:
-                t = torch.cat([t] * noise.shape[0])
-            t = t.to(self.device)
-            positive_copy += [[t] + p[1:]]
-        for n in negative:
-            t = n[0]
-            if t.shape[0] < noise.shape[0]:
-                t = torch.cat([t] * noise.shape[0])
-            t = t.to(self.device)
-            negative_copy += [[t] + n[1:]]
+        compile_module(model.model.diffusion_model)
+
+        cond_cache = {}
+        positive_copy = _prepare_cond(positive, noise.shape[0], self.device, cond_cache)
+        negative_copy = _prepare_cond(negative, noise.shape[0], self.device, cond_cache)
 
         if sampler_name in comfy.samplers.KSampler.SAMPLERS:
-            sampler = comfy.samplers.KSampler(model, steps=steps, device=self.device, sampler=sampler_name, scheduler=scheduler, denoise=denoise)
+            sampler = comfy.samplers.KSampler(model, steps=steps, device=self.device, sampler=sampler_name, scheduler=scheduler, denoise=denoise, autocast_dtype=get_autocast_dtype(self.device))
         else:
             #other samplers
             pass
@@ -254,6 +343,10 @@ class KSampler:
 
 
 class SaveImage:
+    counters = {}
+    #optimize=True tries several zlib strategies per image and is several times slower for a few % smaller files
+    optimize_png = False
+
     def __init__(self):
         self.output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "output")
 
@@ -272,37 +365,59 @@ class SaveImage:
 
     CATEGORY = "image"
 
+    def next_counter(self, filename_prefix):
+        key = (self.output_dir, filename_prefix)
+        if key not in self.counters:
+            #only scan the output folder the first time a prefix is used, after that the counter is tracked here
+            start = filename_prefix + "_"
+            counter = 0
+            with os.scandir(self.output_dir) as it:
+                for entry in it:
+                    if entry.name.startswith(start):
+                        try:
+                            digits = int(entry.name[len(start):].split('_')[0])
+                        except ValueError:
+                            digits = 0
+                        counter = max(counter, digits)
+            self.counters[key] = counter + 1
+        return self.counters[key]
+
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
-        def map_filename(filename):
-            prefix_len = len(filename_prefix)
-            prefix = filename[:prefix_len + 1]
-            try:
-                digits = int(filename[prefix_len + 1:].split('_')[0])
-            except:
-                digits = 0
-            return (digits, prefix)
-        try:
-            counter = max(filter(lambda a: a[1][:-1] == filename_prefix and a[1][-1] == "_", map(map_filename, os.listdir(self.output_dir))))[0] + 1
-        except ValueError:
-            counter = 1
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(i.astype(np.uint8))
-            metadata = PngInfo()
-            if prompt is not None:
-                metadata.add_text("prompt", json.dumps(prompt))
-            if extra_pnginfo is not None:
-                for x in extra_pnginfo:
-                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-            img.save(f"output/{filename_prefix}_{counter:05}_.png", pnginfo=metadata, optimize=True)
+        counter = self.next_counter(filename_prefix)
+        #quantize on the device the images are on so only uint8 data gets copied to the cpu, contiguous so that
+        #each images_u8[i] is a plain view Image.fromarray can use without making its own copy
+        images_u8 = (images.clamp(0, 1) * 255.0).round().to(torch.uint8).contiguous().cpu().numpy()
+        metadata = PngInfo()
+        if prompt is not None:
+            metadata.add_text("prompt", json.dumps(prompt))
+        if extra_pnginfo is not None:
+            for x in extra_pnginfo:
+                metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+        def save(task):
+            Image.fromarray(task[0]).save(task[1], pnginfo=metadata, optimize=self.optimize_png)
+
+        tasks = []
+        for i in images_u8:
+            #the cached counter can fall behind if something else writes to the output folder, never overwrite
+            path = os.path.join(self.output_dir, f"{filename_prefix}_{counter:05}_.png")
+            while os.path.exists(path):
+                counter += 1
+                path = os.path.join(self.output_dir, f"{filename_prefix}_{counter:05}_.png")
+            tasks += [(i, path)]
             counter += 1
+        self.counters[(self.output_dir, filename_prefix)] = counter
+
+        #PIL releases the GIL while zlib compresses so the pngs can be encoded in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(8, len(tasks)))) as ex:
+            list(ex.map(save, tasks))
 
 class LoadImage:
     input_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "input")
     @classmethod
     def INPUT_TYPES(s):
         return {"required":
-                    {"image": (os.listdir(s.input_dir), )},
+                    {"image": (get_filename_list(s.input_dir), )},
                 }
 
     CATEGORY = "image"
@@ -312,16 +427,17 @@ class LoadImage:
     def load_image(self, image):
         image_path = os.path.join(self.input_dir, image)
         image = Image.open(image_path).convert("RGB")
-        image = np.array(image).astype(np.float32) / 255.0
-        image = torch.from_numpy(image[None])[None,]
-        return image
+        image = torch.from_numpy(np.array(image, dtype=np.uint8))
+        image = image.to(torch.float32).mul_(1.0 / 255.0)
+        return (image.unsqueeze(0),)
 
     @classmethod
     def IS_CHANGED(s, image):
         image_path = os.path.join(s.input_dir, image)
         m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
+        with open(image_path, 'rb', buffering=0) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                m.update(chunk)
         return m.digest().hex()
 
 